@@ -9,6 +9,9 @@ app = Celery(
     include=['tasks'] # Tells Celery where to find our task functions
 )
 
+# NOTE: Start workers with fair scheduling so short claims don't queue behind
+# slow OCR-heavy ones on the same prefork process:
+#   celery -A celery_app worker -Ofair --concurrency=N
 app.conf.update(
     task_serializer='json',
     accept_content=['json'],
@@ -17,6 +20,25 @@ app.conf.update(
     enable_utc=True,
     task_acks_late=True,
     worker_prefetch_multiplier=1,
+    # Results carry full OCR/lab-report text plus the FHIR bundle; zstd
+    # shrinks that English text ~4x on its way through Redis (kombu
+    # auto-negotiates decompression via the content-encoding header).
+    task_compression='zstd',
+    result_compression='zstd',
+    # Don't ack (and thus drop) tasks that failed or timed out; with
+    # acks_late this lets a crashed worker's claim be redelivered.
+    task_acks_on_failure_or_timeout=False,
+    # Claim processing can run for tens of seconds; keep Redis from
+    # redelivering a task that's still legitimately running.
+    broker_transport_options={'visibility_timeout': 3600},
+    # Route slow OCR subtasks away from cheap DICOM header reads so a
+    # dedicated worker pool (with the Tesseract model resident) handles them:
+    #   celery -A celery_app worker -Q ocr -Ofair --concurrency=2
+    #   celery -A celery_app worker -Q fast,celery -Ofair --concurrency=8
+    task_routes={
+        'tasks.ocr_*': {'queue': 'ocr'},
+        'tasks.dicom_*': {'queue': 'fast'},
+    },
 )
 
 if __name__ == '__main__':
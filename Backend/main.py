@@ -1,16 +1,20 @@
 import os
-import shutil
 import uuid
-import json
 import hashlib
+import tarfile
+import xxhash
+from collections import deque
 from datetime import datetime
 from typing import Optional, Dict, Any
+import orjson
 from fastapi import FastAPI, File, UploadFile, Form
-from fastapi.responses import JSONResponse
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import JSONResponse, FileResponse
 from fastapi.middleware.cors import CORSMiddleware
+from celery import chord
 from celery.result import AsyncResult
 from celery_app import app as celery_app
-from tasks import process_claim_async
+from tasks import dicom_extract, ocr_lab_pdf, ocr_image, finalize_validation
 
 app = FastAPI(title="AyurAnkh Async API")
 
@@ -23,9 +27,40 @@ app.add_middleware(
     allow_headers=["*"],  # Allows all headers
 )
 
-# --- In-Memory Databases ---
-IMMUTABLE_LOGS = []
-IDEMPOTENCY_DB = {}
+# --- Immutable Override Log ---
+# Bounded in-memory tail (O(1) memory instead of a list that grows forever)
+# plus an fsync'd append-only NDJSON file, which is what actually earns the
+# name "immutable": records survive restarts and can't be dropped by a crash.
+# Created once at startup so the submit path skips a per-request makedirs
+TEMP_UPLOAD_ROOT = os.path.join(os.getcwd(), "temp_uploads")
+os.makedirs(TEMP_UPLOAD_ROOT, exist_ok=True)
+
+def _pack_uploads(tar_path, uploads):
+    """Packs (key, UploadFile) pairs into one tar. Blocking; run in a thread."""
+    with tarfile.open(tar_path, "w") as tar:
+        for key, up_file in uploads:
+            up_file.file.seek(0, os.SEEK_END)
+            size = up_file.file.tell()
+            up_file.file.seek(0)
+            info = tarfile.TarInfo(name=key)
+            info.size = size
+            tar.addfile(info, up_file.file)
+
+OVERRIDE_LOG_PATH = os.path.join(os.getcwd(), "override.log")
+IMMUTABLE_LOGS = deque(maxlen=10_000)
+_override_log_fh = open(OVERRIDE_LOG_PATH, "ab")
+
+def _append_override_log(log):
+    IMMUTABLE_LOGS.append(log)
+    _override_log_fh.write(orjson.dumps(log) + b"\n")
+    _override_log_fh.flush()
+    os.fsync(_override_log_fh.fileno())
+
+# Idempotency keys live in Redis (reusing the Celery result-backend client)
+# so the check is atomic across uvicorn workers and self-expiring, instead
+# of a per-process dict that leaks memory and misses cross-worker dupes.
+redis_client = celery_app.backend.client
+IDEMPOTENCY_TTL = 86400  # seconds
 
 @app.post("/process-claim-async/")
 async def submit_claim_async(
@@ -43,53 +78,87 @@ async def submit_claim_async(
 ):
     # 1. Idempotency Check
     if not idempotency_key:
+         # Not a security primitive, just a dedup key: xxh3 is ~10x faster
+         # than SHA-256 on short inputs. SHA-256 stays in doctor_override
+         # where it acts as a tamper-evident signature.
          key_raw = f"{verified_patient_id}-{dicom_file.filename}-{doctor_diagnosis}"
-         idempotency_key = hashlib.sha256(key_raw.encode()).hexdigest()
+         idempotency_key = xxhash.xxh3_128_hexdigest(key_raw.encode())
     
-    # FIXED INDENTATION HERE
-    if idempotency_key in IDEMPOTENCY_DB:
+    # Atomic claim of the key: SET NX only succeeds for the first submitter,
+    # and the TTL keeps Redis from accumulating stale keys forever. The SET
+    # and the GET (for the duplicate response) go out in one pipelined
+    # round-trip instead of two.
+    task_id = str(uuid.uuid4())
+    pipe = redis_client.pipeline()
+    pipe.set(f"idem:{idempotency_key}", task_id, nx=True, ex=IDEMPOTENCY_TTL)
+    pipe.get(f"idem:{idempotency_key}")
+    # redis-py is synchronous; keep its round-trip off the event loop
+    was_set, stored = await run_in_threadpool(pipe.execute)
+    if not was_set:
         return JSONResponse(status_code=409, content={
             "error": "Duplicate Submission Detected",
-            "original_task_id": IDEMPOTENCY_DB[idempotency_key]
+            "original_task_id": stored.decode() if stored else None
         })
 
-    # 2. Create Temp Directory
-    task_id = str(uuid.uuid4())
-    temp_dir = os.path.join(os.getcwd(), "temp_uploads", task_id)
-    os.makedirs(temp_dir, exist_ok=True)
-    
-    file_paths = {}
-    def save_file(up_file, key):
-        path = os.path.join(temp_dir, up_file.filename)
-        with open(path, "wb") as f: shutil.copyfileobj(up_file.file, f)
-        file_paths[key] = path
-
-    save_file(dicom_file, "dicom")
-    if lab_report_pdf: save_file(lab_report_pdf, "lab_pdf")
-    if geotagged_patient_photo: save_file(geotagged_patient_photo, "patient_photo")
-    if identity_document_image: save_file(identity_document_image, "identity_doc")
-    if consent_form_image: save_file(consent_form_image, "consent_image")
-
-    # 3. Prepare Data
-    identity_data = json.loads(verified_identity_payload) if verified_identity_payload else {}
-    consent_data = json.loads(digital_consent_payload) if digital_consent_payload else {}
-
-    claim_data = {
-        "verified_patient_id": verified_patient_id,
-        "doctor_diagnosis": doctor_diagnosis,
-        "identity_data": identity_data,
-        "consent_data": consent_data,
-        "patient_geotag": patient_geotag
-    }
-
-    # 4. Launch Task
-    process_claim_async.apply_async(args=[claim_data, file_paths], task_id=task_id)
-    IDEMPOTENCY_DB[idempotency_key] = task_id
+    # Anything past this point must release the claimed key on failure:
+    # otherwise a disk-full or broker hiccup leaves "idem:..." pointing at a
+    # task that was never enqueued, and every retry 409s for the next 24h.
+    tar_path = os.path.join(TEMP_UPLOAD_ROOT, f"{task_id}.tar")
+    try:
+        # 2. Pack Uploads
+        # One tar per task instead of a directory plus up to five files: a
+        # single inode to create and unlink, one sequential write through the
+        # page cache, and the worker reads members straight out of the archive.
+        uploads = [("dicom", dicom_file)]
+        if lab_report_pdf: uploads.append(("lab_pdf", lab_report_pdf))
+        if geotagged_patient_photo: uploads.append(("patient_photo", geotagged_patient_photo))
+        if identity_document_image: uploads.append(("identity_doc", identity_document_image))
+        if consent_form_image: uploads.append(("consent_image", consent_form_image))
+
+        await run_in_threadpool(_pack_uploads, tar_path, uploads)
+
+        # Keys map to tar member names so downstream .get(key) checks still work.
+        file_paths = {"tar_path": tar_path}
+        for key, _ in uploads:
+            file_paths[key] = key
+
+        # 3. Prepare Data
+        identity_data = orjson.loads(verified_identity_payload) if verified_identity_payload else {}
+        consent_data = orjson.loads(digital_consent_payload) if digital_consent_payload else {}
+
+        claim_data = {
+            "verified_patient_id": verified_patient_id.strip(),
+            "doctor_diagnosis": doctor_diagnosis,
+            "identity_data": identity_data,
+            "consent_data": consent_data,
+            "patient_geotag": patient_geotag
+        }
+
+        # 4. Launch Pipeline
+        # Extraction fans out as a chord so OCR subtasks can run on dedicated
+        # workers (queue 'ocr') while DICOM header reads stay on fast workers
+        # (queue 'fast'). The callback carries the client-visible task_id, so
+        # /claim-status/{task_id} works unchanged.
+        header = [dicom_extract.s(file_paths)]
+        if "lab_pdf" in file_paths: header.append(ocr_lab_pdf.s(file_paths))
+        if "identity_doc" in file_paths: header.append(ocr_image.s(file_paths, "identity_doc", "IDENTITY_OCR"))
+        if "consent_image" in file_paths: header.append(ocr_image.s(file_paths, "consent_image", "CONSENT_OCR"))
+        # Publishing to the broker is blocking kombu I/O — same treatment
+        callback = finalize_validation.s(claim_data, file_paths).set(task_id=task_id)
+        await run_in_threadpool(chord(header), callback)
+    except Exception:
+        await run_in_threadpool(redis_client.delete, f"idem:{idempotency_key}")
+        if os.path.exists(tar_path):
+            os.remove(tar_path)
+        raise
 
     return {"message": "Claim accepted.", "task_id": task_id, "idempotency_key": idempotency_key}
 
+# Plain 'def' handlers below: Starlette runs them in its threadpool, so their
+# blocking Redis reads / hashing / fsync never stall the event loop.
+
 @app.get("/claim-status/{task_id}")
-async def get_claim_status(task_id: str):
+def get_claim_status(task_id: str):
     res = AsyncResult(task_id, app=celery_app)
     resp = {"task_id": task_id, "status": res.status}
     if res.status in ['SUCCESS', 'FAILURE']: resp["result"] = res.result
@@ -97,13 +166,15 @@ async def get_claim_status(task_id: str):
     return resp
 
 @app.post("/doctor-override/")
-async def doctor_override(task_id: str = Form(...), doctor_id: str = Form(...), override_reason: str = Form(...)):
+def doctor_override(task_id: str = Form(...), doctor_id: str = Form(...), override_reason: str = Form(...)):
     log = {"event": "OVERRIDE", "timestamp": datetime.utcnow().isoformat(), "task_id": task_id, "doctor_id": doctor_id, "reason": override_reason, "signature": hashlib.sha256(f"{task_id}{doctor_id}{override_reason}".encode()).hexdigest()}
-    IMMUTABLE_LOGS.append(log)
+    _append_override_log(log)
     return {"status": "OVERRIDE_ACCEPTED", "log": log}
 
 @app.get("/logs/")
-async def view_logs(): return IMMUTABLE_LOGS
+async def view_logs():
+    # Stream the full on-disk history (kernel sendfile, no JSON re-encode).
+    return FileResponse(OVERRIDE_LOG_PATH, media_type="application/x-ndjson")
 
 @app.post("/abdm/hce/submit-claim")
 async def mock_hce_submit(payload: Dict[str, Any]):
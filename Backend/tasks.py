@@ -1,74 +1,209 @@
 import os
+import re
+import copy
+import functools
 import time
 import shutil
-import json
+import tarfile
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from typing import Dict, Any, List
 
+import io
+import cv2
+import xxhash
+import numpy as np
 import pydicom
 import pytesseract
 import fitz  # PyMuPDF
 from PIL import Image
 from celery import shared_task
-from fhir.resources.patient import Patient
-from fhir.resources.observation import Observation
 from fhir.resources.bundle import Bundle
 
 # --- Tesseract Path (Windows) ---
 # UPDATE THIS PATH IF NEEDED FOR YOUR TEAM'S MACHINE
 pytesseract.pytesseract.tesseract_cmd = r'C:\Program Files\Tesseract-OCR\tesseract.exe'
 
+# --- Shared Tesseract API (tesserocr) ---
+# pytesseract spawns a fresh tesseract subprocess per image, reloading ~50 MB
+# of LSTM weights every time. If tesserocr is installed we keep one API handle
+# alive per Celery worker instead. The handle is not thread-safe, so calls are
+# serialized with a lock; pytesseract stays as the fallback (e.g. on Windows
+# dev machines where tesserocr won't build, or when no tessdata is installed:
+# the wheel bundles libtesseract but no eng.traineddata, and PyTessBaseAPI
+# raises RuntimeError — not ImportError — when it can't find the model).
+try:
+    import tesserocr
+    _tessdata = os.environ.get('TESSDATA_PREFIX')
+    _TESS_API = tesserocr.PyTessBaseAPI(lang='eng', oem=tesserocr.OEM.LSTM_ONLY, psm=tesserocr.PSM.SINGLE_BLOCK,
+                                        **({'path': _tessdata} if _tessdata else {}))
+    _TESS_LOCK = threading.Lock()
+except (ImportError, RuntimeError):
+    _TESS_API = None
+    _TESS_LOCK = None
+
 # --- Helper Functions ---
-def _process_dicom(file_path: str) -> Dict[str, Any]:
+_DICOM_TAGS = ["PatientID", "PatientName", "AccessionNumber", "StudyDate", "Modality"]
+
+# Optional GPU JPEG decoding for pixel-level validation. Like tesserocr above,
+# degrade gracefully when the extra wheel isn't installed.
+try:
+    from nvjpeg import NvJpeg
+    _NVJPEG = NvJpeg()
+except ImportError:
+    _NVJPEG = None
+
+def _decode_dicom_frame(data: bytes):
+    """Decodes the first image frame of a DICOM upload as a numpy array.
+
+    Not on the claim hot path yet — current rules only read header tags. When
+    pixel-level rules land (e.g. running a model over the study), this pulls
+    the encapsulated JPEG stream straight out of PixelData and hands the raw
+    bytes to nvjpeg when available, skipping pydicom's much slower Python
+    pixel handlers; PIL is the fallback decoder. Takes bytes like the other
+    extractors, so it works on tar members via _read_upload.
+    """
+    ds = pydicom.dcmread(io.BytesIO(data), force=True)
+    file_meta = getattr(ds, "file_meta", None)
+    tsyntax = file_meta.get("TransferSyntaxUID") if file_meta else None
+    if tsyntax is not None and tsyntax.is_encapsulated:
+        try:
+            from pydicom.encaps import get_frame  # pydicom >= 3
+            jpeg_bytes = get_frame(ds.PixelData, 0, number_of_frames=int(ds.get("NumberOfFrames", 1)))
+        except ImportError:
+            from pydicom.encaps import defragment_data  # pydicom 2.x
+            jpeg_bytes = defragment_data(ds.PixelData)
+        if _NVJPEG is not None:
+            return _NVJPEG.decode(jpeg_bytes)
+        return np.asarray(Image.open(io.BytesIO(jpeg_bytes)))
+    return ds.pixel_array
+
+def _read_upload(file_paths: Dict[str, str], key: str) -> bytes:
+    """Pulls one upload out of the task's tar archive into memory.
+
+    The API packs all uploads for a claim into a single tar (one inode, one
+    sequential write); workers extract members instead of reopening loose
+    files, and pydicom/MuPDF/OpenCV all accept in-memory buffers.
+    """
+    with tarfile.open(file_paths["tar_path"], "r") as tar:
+        return tar.extractfile(file_paths[key]).read()
+
+def _extraction_failed(value) -> bool:
+    """Recognizes the extractors' error sentinels: the (None, {error}) tuple
+    from _process_dicom and the error-prefixed strings from PDF/OCR."""
+    if isinstance(value, tuple):
+        return "error" in value[1]
+    return isinstance(value, str) and value.startswith(("PDF Error:", "OCR Error:"))
+
+def _content_cache(func):
+    """Memoizes an extractor on the xxh3 digest of its input bytes.
+
+    With task_acks_late a redelivered task redoes all extraction; the cache
+    makes such retries near-free, and identical uploads across distinct
+    claims (same scan resubmitted) skip the parse/OCR cost too. Bounded LRU,
+    per worker process. A concurrent miss on two threads just computes twice.
+
+    Error results are deliberately not cached: a transient failure (e.g. the
+    Tesseract subprocess getting killed) would otherwise poison that content
+    hash for the life of the worker.
+    """
+    cache = OrderedDict()
+    @functools.wraps(func)
+    def wrapper(data: bytes):
+        key = xxhash.xxh3_128_digest(data)
+        if key in cache:
+            cache.move_to_end(key)
+            return cache[key]
+        value = func(data)
+        if not _extraction_failed(value):
+            cache[key] = value
+            if len(cache) > 256:
+                cache.popitem(last=False)
+        return value
+    return wrapper
+
+@_content_cache
+def _process_dicom(data: bytes):
+    """Returns (dataset, summary). The dataset is kept so validation rules can
+    pull any header tag later without re-parsing the upload."""
     try:
-        ds = pydicom.dcmread(file_path, force=True)
-        return {
-            "PatientID": str(ds.get("PatientID", "N/A")),
+        # We only need five header tags: stop before PixelData (which can be
+        # hundreds of MB for a CT series) and only materialize those tags.
+        ds = pydicom.dcmread(io.BytesIO(data), force=True, stop_before_pixels=True, specific_tags=_DICOM_TAGS)
+        return ds, {
+            # Stripped here so the validation engine compares as-is
+            "PatientID": str(ds.get("PatientID", "N/A")).strip(),
             "PatientName": str(ds.get("PatientName", "N/A")),
             "AccessionNumber": str(ds.get("AccessionNumber", "N/A")),
             "StudyDate": str(ds.get("StudyDate", "N/A")),
             "Modality": str(ds.get("Modality", "N/A")),
         }
     except Exception as e:
-        return {"error": str(e)}
+        return None, {"error": str(e)}
 
-def _process_pdf(file_path: str) -> str:
+@_content_cache
+def _process_pdf(data: bytes) -> str:
     try:
-        doc = fitz.open(file_path)
-        text = ""
-        for page in doc:
-            text += page.get_text()
-        doc.close()
-        return text
+        # sort=False skips MuPDF's geometric reordering pass (we only scan the
+        # text for keywords), and join avoids quadratic string concatenation.
+        with fitz.open(stream=data, filetype="pdf") as doc:
+            parts = [doc[i].get_text("text", sort=False) for i in range(doc.page_count)]
+        return "".join(parts)
     except Exception as e:
         return f"PDF Error: {e}"
 
-def _process_image_ocr(file_path: str) -> str:
+@_content_cache
+def _process_image_ocr(data: bytes) -> str:
     try:
-        img = Image.open(file_path)
-        text = pytesseract.image_to_string(img)
+        # Grayscale + upscale + Otsu binarization: Tesseract burns most of its
+        # time on layout analysis of raw phone photos; clean ~300 DPI binary
+        # input is both 2-3x faster and more accurate on forms.
+        img = cv2.imdecode(np.frombuffer(data, np.uint8), cv2.IMREAD_GRAYSCALE)
+        if img is None:
+            raise ValueError("unreadable image")
+        if max(img.shape) < 1500:  # phone crops/scans below ~300 DPI
+            img = cv2.resize(img, None, fx=2, fy=2, interpolation=cv2.INTER_CUBIC)
+        _, img = cv2.threshold(img, 0, 255, cv2.THRESH_BINARY | cv2.THRESH_OTSU)
+        if _TESS_API is not None:
+            with _TESS_LOCK:
+                _TESS_API.SetImage(Image.fromarray(img))
+                text = _TESS_API.GetUTF8Text()
+        else:
+            # --psm 6 (single text block) skips auto layout detection,
+            # --oem 1 forces the faster LSTM-only engine.
+            text = pytesseract.image_to_string(img, config='--oem 1 --psm 6 -l eng')
         return text
     except Exception as e:
         return f"OCR Error: {e}"
 
-def _run_validation_engine(claim_data, dicom_meta, lab_text, file_paths, ocr_results) -> Dict[str, Any]:
+_CRITICAL_DIAG_RE = re.compile(r"critical|fracture", re.I)
+_NORMAL_LAB_RE = re.compile(r"normal", re.I)
+
+def _run_validation_engine(claim_data, dicom_meta, lab_text, file_paths, ocr_results, dicom_ds=None) -> Dict[str, Any]:
     """
     The 'Agentic' Zero-Trust Engine.
+
+    dicom_ds is the already-parsed pydicom Dataset (header only), so future
+    rules can check any tag without re-reading the file.
     """
     failures = []
-    
+
     # RULE 1: Identity Verification (CRITICAL)
-    verified_id = str(claim_data.get("verified_patient_id")).strip()
-    dicom_id = str(dicom_meta.get("PatientID")).strip()
-    
+    # IDs arrive pre-stripped (form parser and _process_dicom normalize at
+    # the source), so this is a straight comparison.
+    verified_id = str(claim_data.get("verified_patient_id"))
+    dicom_id = str(dicom_meta.get("PatientID"))
+
     if dicom_meta.get("error"):
          failures.append({"confidence": "CRITICAL", "reason": f"DICOM Corrupt: {dicom_meta['error']}"})
     elif verified_id != dicom_id:
         failures.append({"confidence": "CRITICAL", "reason": f"Patient ID Mismatch: Form({verified_id}) vs DICOM({dicom_id})"})
 
     # RULE 2: Clinical Consistency (HIGH)
-    diag = claim_data.get("doctor_diagnosis", "").lower()
-    lab = lab_text.lower()
-    if ("critical" in diag or "fracture" in diag) and "normal" in lab:
+    # Case-insensitive regexes scan once, instead of .lower() copies of the
+    # diagnosis and the (potentially large) lab text plus two substring tests.
+    if _CRITICAL_DIAG_RE.search(claim_data.get("doctor_diagnosis", "")) and _NORMAL_LAB_RE.search(lab_text):
          failures.append({"confidence": "HIGH", "reason": "Lab report says 'Normal' but Diagnosis is Critical."})
 
     # RULE 3: Fraud Detection - Geotag (MEDIUM)
@@ -86,28 +221,123 @@ def _run_validation_engine(claim_data, dicom_meta, lab_text, file_paths, ocr_res
     if any(f["confidence"] == "HIGH" for f in failures): return {"status": "FLAGGED_HIGH", "failures": failures}
     return {"status": "PASSED_MEDIUM", "failures": failures}
 
+# Only patient id and diagnosis vary between claims, so the bundle shape is
+# fixed. Validate it through pydantic once at import; per-claim generation is
+# then a deepcopy plus three assignments instead of three model validations.
+_FHIR_BUNDLE_TEMPLATE = {
+    "resourceType": "Bundle",
+    "type": "transaction",
+    "entry": [
+        {
+            "resource": {"resourceType": "Patient", "id": "template"},
+            "request": {"method": "POST", "url": "Patient"},
+        },
+        {
+            "resource": {
+                "resourceType": "Observation",
+                "status": "final",
+                "code": {"text": "Diagnosis"},
+                "valueString": "template",
+                "subject": {"reference": "Patient/template"},
+            },
+            "request": {"method": "POST", "url": "Observation"},
+        },
+    ],
+}
+Bundle(**_FHIR_BUNDLE_TEMPLATE)  # sanity check: fail loudly at worker start
+
 def _generate_mock_fhir(claim_data) -> Dict[str, Any]:
-    """Generates a valid FHIR Bundle."""
+    """Generates a valid FHIR Bundle from the pre-validated template."""
     try:
-        patient = Patient(id=claim_data["verified_patient_id"])
-        obs = Observation(
-            status="final",
-            code={"text": "Diagnosis"},
-            valueString=claim_data["doctor_diagnosis"],
-            subject={"reference": f"Patient/{patient.id}"}
-        )
-        bundle = Bundle(
-            type="transaction",
-            entry=[
-                {"resource": patient, "request": {"method": "POST", "url": "Patient"}},
-                {"resource": obs, "request": {"method": "POST", "url": "Observation"}}
-            ]
-        )
-        return json.loads(bundle.json())
+        pid = claim_data["verified_patient_id"]
+        bundle = copy.deepcopy(_FHIR_BUNDLE_TEMPLATE)
+        bundle["entry"][0]["resource"]["id"] = pid
+        obs = bundle["entry"][1]["resource"]
+        obs["valueString"] = claim_data["doctor_diagnosis"]
+        obs["subject"]["reference"] = f"Patient/{pid}"
+        return bundle
     except Exception as e:
         return {"error": f"FHIR Generation Failed: {e}"}
 
-# --- MAIN CELERY TASK ---
+def _assemble_and_validate(claim_data, file_paths, results, dicom_ds=None) -> Dict[str, Any]:
+    """Shared tail of the pipeline: validation, FHIR bundle, final status."""
+    # Ensure lab text exists even if file wasn't provided, to avoid KeyErrors
+    if "lab_report_text" not in results:
+        results["lab_report_text"] = "N/A"
+
+    val_res = _run_validation_engine(claim_data, results["dicom_metadata"], results["lab_report_text"], file_paths, results["ocr_results"], dicom_ds=dicom_ds)
+    results["validation_result"] = val_res
+
+    if val_res["status"] in ["PASSED", "FLAGGED_HIGH", "PASSED_MEDIUM"]:
+        results["fhir_bundle"] = _generate_mock_fhir(claim_data)
+
+    if val_res["status"] == "FAILED_CRITICAL":
+        results["status"] = "FAILED"
+    elif val_res["status"] == "FLAGGED_HIGH":
+        results["status"] = "FLAGGED"  # Needs override
+    else:
+        results["status"] = "COMPLETED"
+
+    return results
+
+# --- CHORD-BASED PIPELINE ---
+# Extraction runs as a chord of small routed subtasks so operators can give
+# memory-heavy OCR work (resident Tesseract model) its own workers, separate
+# from cheap DICOM header reads:
+#   celery -A celery_app worker -Q ocr --concurrency=2
+#   celery -A celery_app worker -Q fast,celery --concurrency=8
+# Each extraction subtask returns [key, value, step_label] for the callback.
+
+# A raised exception here would fail the whole chord and the client would see
+# FAILURE with an empty result, so each subtask catches _read_upload errors
+# (missing/corrupt tar) and returns the same sentinels the _process_* helpers
+# use — finalize_validation then still runs and reports the reason.
+
+@shared_task(name="tasks.dicom_extract")
+def dicom_extract(file_paths: Dict[str, str]):
+    try:
+        _, summary = _process_dicom(_read_upload(file_paths, "dicom"))
+    except Exception as e:
+        summary = {"error": str(e)}
+    return ["dicom_metadata", summary, "DICOM"]
+
+@shared_task(name="tasks.ocr_lab_pdf")
+def ocr_lab_pdf(file_paths: Dict[str, str]):
+    try:
+        text = _process_pdf(_read_upload(file_paths, "lab_pdf"))
+    except Exception as e:
+        text = f"PDF Error: {e}"
+    return ["lab_pdf", text, "LAB_PDF"]
+
+@shared_task(name="tasks.ocr_image")
+def ocr_image(file_paths: Dict[str, str], key: str, label: str):
+    try:
+        text = _process_image_ocr(_read_upload(file_paths, key))
+    except Exception as e:
+        text = f"OCR Error: {e}"
+    return [key, text, label]
+
+@shared_task(bind=True, name="tasks.finalize_validation")
+def finalize_validation(self, extracted: List[List[Any]], claim_data: Dict[str, Any], file_paths: Dict[str, str]):
+    """Chord callback: assembles subtask outputs and runs the validation tail."""
+    results = {"status": "PROCESSING", "steps_completed": [], "ocr_results": {}}
+    try:
+        self.update_state(state='VALIDATING', meta={'step': 'Running AI Validation Agents...'})
+        for key, value, label in extracted:
+            if key == "dicom_metadata":
+                results["dicom_metadata"] = value
+            else:
+                if key == "lab_pdf":
+                    # Special case: save lab text separately for validation engine
+                    results["lab_report_text"] = value
+                results["ocr_results"][key] = value
+            results["steps_completed"].append(label)
+
+        return _assemble_and_validate(claim_data, file_paths, results)
+    except Exception as e:
+        return {"status": "ERROR", "error": str(e)}
+
+# --- MONOLITHIC TASK (single-queue deployments) ---
 @shared_task(bind=True, name="tasks.process_claim_async")
 def process_claim_async(self, claim_data: Dict[str, Any], file_paths: Dict[str, str]):
     """
@@ -116,51 +346,35 @@ def process_claim_async(self, claim_data: Dict[str, Any], file_paths: Dict[str,
     results = {"status": "PROCESSING", "steps_completed": [], "ocr_results": {}}
     
     try:
-        # 1. DICOM Processing (Heavy I/O)
-        self.update_state(state='PROCESSING', meta={'step': 'Processing DICOM...'})
-        results["dicom_metadata"] = _process_dicom(file_paths["dicom"])
-        results["steps_completed"].append("DICOM")
+        # 1. Parallel Extraction (Heavy I/O + CPU)
+        # Tesseract and MuPDF release the GIL in their native cores, so threads
+        # run the four extraction branches truly concurrently. Wall time drops
+        # to roughly the slowest branch instead of the sum of all of them.
+        self.update_state(state='PROCESSING', meta={'step': 'Parallel extraction...'})
 
-        # 2. Optional OCR Tasks (Heavy CPU)
-        # We loop through possible optional files and OCR them if they exist
+        branches = [("dicom", _process_dicom, "DICOM")]
         for key, label in [("lab_pdf", "LAB_PDF"), ("identity_doc", "IDENTITY_OCR"), ("consent_image", "CONSENT_OCR")]:
             if file_paths.get(key):
-                self.update_state(state='PROCESSING', meta={'step': f'Reading {label}...'})
-                
-                if key == "lab_pdf":
-                    # Use specialized PDF reader
-                    text = _process_pdf(file_paths[key])
-                    # Special case: save lab text separately for validation engine
-                    results["lab_report_text"] = text
+                func = _process_pdf if key == "lab_pdf" else _process_image_ocr
+                branches.append((key, func, label))
+
+        dicom_ds = None
+        with ThreadPoolExecutor(max_workers=4) as pool:
+            futures = [(key, label, pool.submit(lambda f=func, k=key: f(_read_upload(file_paths, k)))) for key, func, label in branches]
+            for key, label, future in futures:
+                value = future.result()
+                if key == "dicom":
+                    dicom_ds, results["dicom_metadata"] = value
                 else:
-                    # Use generic Image OCR for identity/consent images
-                    text = _process_image_ocr(file_paths[key])
-                
-                results["ocr_results"][key] = text
+                    if key == "lab_pdf":
+                        # Special case: save lab text separately for validation engine
+                        results["lab_report_text"] = value
+                    results["ocr_results"][key] = value
                 results["steps_completed"].append(label)
 
-        # Ensure lab text exists even if file wasn't provided, to avoid KeyErrors
-        if "lab_report_text" not in results:
-            results["lab_report_text"] = "N/A"
-
-        # 3. Run "Zero-Trust" Validation Engine (CPU)
+        # 2. Validation / FHIR / final status (shared with the chord callback)
         self.update_state(state='VALIDATING', meta={'step': 'Running AI Validation Agents...'})
-        val_res = _run_validation_engine(claim_data, results["dicom_metadata"], results["lab_report_text"], file_paths, results["ocr_results"])
-        results["validation_result"] = val_res
-        
-        # 4. Generate FHIR Bundle (Simulated)
-        if val_res["status"] in ["PASSED", "FLAGGED_HIGH", "PASSED_MEDIUM"]:
-             results["fhir_bundle"] = _generate_mock_fhir(claim_data)
-
-        # 5. Final Status Determination
-        if val_res["status"] == "FAILED_CRITICAL":
-            results["status"] = "FAILED"
-        elif val_res["status"] == "FLAGGED_HIGH":
-             results["status"] = "FLAGGED" # Needs override
-        else:
-            results["status"] = "COMPLETED"
-
-        return results
+        return _assemble_and_validate(claim_data, file_paths, results, dicom_ds=dicom_ds)
 
     except Exception as e:
         return {"status": "ERROR", "error": str(e)}
@@ -1,7 +1,9 @@
 #!/bin/bash
 
 # Use 'python -m' to guarantee it finds the installed modules
-python -m celery -A celery_app worker --loglevel=info --concurrency=2 &
+# Single worker consumes all queues in the demo deployment; split -Q ocr
+# and -Q fast,celery across separate workers when scaling out.
+python -m celery -A celery_app worker --loglevel=info -Ofair --concurrency=2 -Q celery,fast,ocr &
 
 # Start uvicorn the same way
 python -m uvicorn main:app --host 0.0.0.0 --port $PORT
\ No newline at end of file